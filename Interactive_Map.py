@@ -1,12 +1,13 @@
-import json
+import hmac
+import orjson
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-from streamlit_folium import st_folium
 import folium
 from folium.plugins import LocateControl
 import openrouteservice
 import markdown
-import random
+import math
 import googlemaps
 import polyline
 
@@ -21,6 +22,40 @@ DEBUGGING = False
 PPL_API_KEY = st.secrets["PERPLEXITY_API_KEY"]
 GMAPS_API_KEY = st.secrets["GMAPS_API_KEY"]
 
+@st.cache_resource
+def get_gmaps():
+    """Return a Google Maps client shared across reruns and sessions."""
+    return googlemaps.Client(key=GMAPS_API_KEY)
+
+@st.cache_resource
+def get_ppl_session():
+    """Return a keep-alive HTTP session for the Perplexity API."""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {PPL_API_KEY}",
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    })
+    return session
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def geocode_address(address: str):
+    """Return (lat, lon) for a normalized address or None if Google finds nothing."""
+    results = get_gmaps().geocode(address)
+    if not results:
+        return None
+    loc = results[0]["geometry"]["location"]
+    return loc["lat"], loc["lng"]
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def render_markdown(text: str) -> str:
+    """Convert a chat message to HTML once; past turns never change, so reruns hit the cache."""
+    return markdown.markdown(text)
+
+def normalize_address(address: str) -> str:
+    """Collapse whitespace and case so trivial variations share a geocode cache entry."""
+    return " ".join(address.split()).lower()
+
 translations = {
     "search_placeholder": {"es": "¿Qué quieres buscar en Valencia?", "en": "What do you want to search in Valencia?"},
     "clear_button": {"es": "🗑️ Borrar Todo", "en": "🗑️ Clear All"},
@@ -33,6 +68,8 @@ translations = {
 defaults = {
     "history": [{'assistant': translations["assistant"]["es"]}],  # List of dicts: {'user','assistant','sources'}
     "points": [],  # Accumulated markers [{'name','lat','lon'}]
+    "coord_set": set(),  # (lat, lon) of accumulated markers, for O(1) overlap checks
+    "dup_counter": {},  # Geocoded (lat, lon) -> number of markers already offset from it
     "routes": [],  # Accumulated routes
     "language": "es",
 }
@@ -44,6 +81,8 @@ def reset_history():
         'assistant': translations["assistant"][st.session_state.language]
     }]
     st.session_state.points = []
+    st.session_state.coord_set = set()
+    st.session_state.dup_counter = {}
     st.session_state.routes = []
     st.rerun()
 
@@ -60,7 +99,7 @@ if "authentication" not in st.session_state:
 if not st.session_state.authentication:
     pwd = st.text_input("Enter password", type="password")
     if st.button("Enter"):
-        if pwd == PASSWORD:
+        if hmac.compare_digest(pwd.encode(), PASSWORD.encode()):
             st.session_state.authentication = True
             st.rerun()
         else:
@@ -128,6 +167,22 @@ header { visibility: hidden; }
 # ----------------------------------------------------------------------------------------------------------------------
 # PROCESS QUERY WITH PERPLEXITY AND ORS
 # ----------------------------------------------------------------------------------------------------------------------
+GOLDEN_ANGLE = math.pi * (3 - math.sqrt(5))  # ~2.39996 rad, spreads duplicate markers evenly
+MAX_WAYPOINTS = 23  # Google Directions allows 25 stops per request, origin and destination included
+
+def walking_polyline(stops):
+    """Return the walking route through 'lat,lon' stops as a list of (lat, lng) in one Directions call."""
+    directions = get_gmaps().directions(
+        origin=stops[0],
+        destination=stops[-1],
+        mode="walking",
+        waypoints=stops[1:-1] or None,
+        optimize_waypoints=True
+    )
+
+    # Decode the overview polyline to latitude/longitude pairs
+    return polyline.decode(directions[0]["overview_polyline"]["points"])
+
 def process_query(user_query):
     system_prompt = (
         "You are an assistant that searches for and responds only with locations in **Valencia, Spain.** "
@@ -178,87 +233,78 @@ def process_query(user_query):
             }
         }
     }
-    headers = {
-        "Authorization": f"Bearer {PPL_API_KEY}",
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
-    resp = requests.post(
+    resp = get_ppl_session().post(
         "https://api.perplexity.ai/chat/completions",
-        headers=headers,
         json=payload,
         timeout=60
     )
 
     resp.raise_for_status()
-    raw = resp.json()
+    raw = orjson.loads(resp.content)
     if DEBUGGING:
         print("RAW response: ", raw)
         print("-"*30)
     content = raw["choices"][0]["message"]["content"]
-    data = json.loads(content)
+    data = orjson.loads(content)
     sources = raw.get("search_results", [])
 
+    # All three keys are required by the response schema
+    points_in, comment, want_route = data["Points"], data["Comment"], data["Route"]
+
     # Add to history
     st.session_state.history.append({
         "user": user_query,
-        "assistant": data.get("Comment", ""),
+        "assistant": comment,
         "sources": sources
     })
 
-    # Geocode addresses and save points
-    gmaps = googlemaps.Client(key=GMAPS_API_KEY)
+    # Geocode addresses concurrently, then save points in the original order
+    places = [(p["name"], p["address"]) for p in points_in]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(geocode_address, normalize_address(addr)) for _, addr in places]
+
     new_points = []
-    for p in data.get("Points", []):
+    existing_coords = st.session_state.coord_set
+    dup_counter = st.session_state.dup_counter
+    for (name, addr), future in zip(places, futures):
         try:
-            address_query = f"{p['address']}"
-            results = gmaps.geocode(address_query)
-            if results:
-                loc = results[0]["geometry"]["location"]
-                lat, lon = loc["lat"], loc["lng"]
-
-                # Avoid overlapping markers
-                existing_coords = [(pt["lat"], pt["lon"]) for pt in st.session_state.points]
+            coords = future.result()
+            if coords:
+                lat, lon = coords
+
+                # Avoid overlapping markers with a deterministic golden-angle spiral around the spot
                 if (lat, lon) in existing_coords:
-                    lat += random.uniform(-0.0001, 0.0001)
-                    lon += random.uniform(-0.0001, 0.0001)
+                    k = dup_counter.get((lat, lon), 0)
+                    dup_counter[(lat, lon)] = k + 1
+                    theta = k * GOLDEN_ANGLE
+                    radius = 0.0001 * math.sqrt(k + 1)
+                    lat, lon = lat + radius * math.cos(theta), lon + radius * math.sin(theta)
                     if DEBUGGING:
-                        print(f"Duplicate coords, offset applied for {p['name']}")
+                        print(f"Duplicate coords, offset applied for {name}")
 
-                point = {"name": p["name"], "lat": lat, "lon": lon, "address": p["address"]}
+                point = {"name": name, "lat": lat, "lon": lon, "address": addr}
                 st.session_state.points.append(point)
+                existing_coords.add((lat, lon))
                 new_points.append(point)
                 if DEBUGGING:
-                    print(f"Geocoded: {p['name']} -> {lat}, {lon}")
+                    print(f"Geocoded: {name} -> {lat}, {lon}")
             else:
                 if DEBUGGING:
-                    print(f"No geocode result for: {p['address']}")
+                    print(f"No geocode result for: {addr}")
         except Exception as e:
             if DEBUGGING:
-                print(f"Error geocoding {p['address']}: {e}")
+                print(f"Error geocoding {addr}: {e}")
             continue
 
     # Calculate route if requested and enough points
-    if data.get("Route") and len(new_points) > 1:
+    if want_route and len(new_points) > 1:
         try:
-            # Prepare origin, destination, and waypoints
-            origin = f"{new_points[0]['lat']},{new_points[0]['lon']}"
-            destination = f"{new_points[-1]['lat']},{new_points[-1]['lon']}"
-            waypoints = [
-                            f"{pt['lat']},{pt['lon']}" for pt in new_points[1:-1]
-                        ] or None
-
-            directions = gmaps.directions(
-                origin=origin,
-                destination=destination,
-                mode="walking",
-                waypoints=waypoints,
-                optimize_waypoints=True
-            )
-
-            # Decode the overview polyline to latitude/longitude pairs
-            encoded = directions[0]["overview_polyline"]["points"]
-            route_coords = polyline.decode(encoded)  # list of (lat, lng)
+            # Split long tours into legs sharing their end stop, fetched concurrently
+            stops = [f"{pt['lat']},{pt['lon']}" for pt in new_points]
+            step = MAX_WAYPOINTS + 1
+            legs = [stops[i:i + step + 1] for i in range(0, len(stops) - 1, step)]
+            with ThreadPoolExecutor(max_workers=len(legs)) as executor:
+                route_coords = [coord for leg in executor.map(walking_polyline, legs) for coord in leg]
 
             # Append to session routes
             st.session_state.routes.append(route_coords)
@@ -271,17 +317,24 @@ def process_query(user_query):
 # -----------------------------------------------------------------------------
 # RENDER MAP AND CHAT
 # -----------------------------------------------------------------------------
-col_map, col_chat = st.columns([3, 2])
-
-with col_map:
+@st.cache_data(max_entries=32, show_spinner=False)
+def render_map(points, routes):
+    """Build the map for the given (name, lat, lon) markers and routes and return its HTML."""
     center = [39.4699, -0.3763]
     m = folium.Map(location=center, zoom_start=13)
     #LocateControl(auto_start=True).add_to(m)
-    for pt in st.session_state.points:
-        folium.Marker([pt["lat"], pt["lon"]], popup=pt["name"]).add_to(m)
-    for r in st.session_state.routes:
+    for name, lat, lon in points:
+        folium.Marker([lat, lon], popup=name).add_to(m)
+    for r in routes:
         folium.PolyLine(r, color="#0068c9", weight=5, dash_array="10, 10").add_to(m)
-    st_folium(m, height=800, width="100%")
+    return m.get_root().render()
+
+col_map, col_chat = st.columns([3, 2])
+
+with col_map:
+    # The map is display-only, so a cached static render replaces st_folium
+    points_key = tuple((pt["name"], pt["lat"], pt["lon"]) for pt in st.session_state.points)
+    st.iframe(render_map(points_key, st.session_state.routes), height=800)
 
 with col_chat:
     # Fixed input at the top of the chat column
@@ -292,13 +345,14 @@ with col_chat:
 
     # Chat container with fixed height and scroll
     with st.container():
-        # Build all chat HTML as a single string
-        chat_html = '<div class="chat-container">'
+        # Collect all chat HTML fragments and join them into a single string
+        chat_parts = ['<div class="chat-container">']
 
         # Display messages in reverse order (newest first)
         for turn in reversed(st.session_state.history):
             # Assistant's response
-            chat_html += f'<div class="assistant-message">{markdown.markdown(turn["assistant"])}</div>' if turn.get("assistant") else ''
+            if turn.get("assistant"):
+                chat_parts.append(f'<div class="assistant-message">{render_markdown(turn["assistant"])}</div>')
 
             # Sources if present
             if turn.get("sources"):
@@ -308,15 +362,16 @@ with col_chat:
                     url = item['url']
                     sources_links.append(f'<a href="{url}" target="_blank">{title}</a>')
                 sources_text = "📚 Sources: " + ", ".join(sources_links)
-                chat_html += f'<div class="sources-text">{sources_text}</div>'
+                chat_parts.append(f'<div class="sources-text">{sources_text}</div>')
 
             # User's message
-            chat_html += f'<div class="user-message">{turn.get("user")}</div>' if turn.get("user") else ''
+            if turn.get("user"):
+                chat_parts.append(f'<div class="user-message">{turn["user"]}</div>')
 
-        chat_html += '</div>'
+        chat_parts.append('</div>')
 
         # Render the entire chat at once
-        st.markdown(chat_html, unsafe_allow_html=True)
+        st.markdown("".join(chat_parts), unsafe_allow_html=True)
 
         if st.button(translations["clear_button"][st.session_state.language]):
             reset_history()
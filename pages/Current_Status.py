@@ -1,9 +1,12 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 import requests
-import json
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import time
 
 # Page configuration
 st.set_page_config(page_title="Valencia City Data", layout="wide", initial_sidebar_state="expanded")
@@ -23,51 +26,63 @@ DATASETS = {
 }
 
 # Function to get data from API
-@st.cache_data(ttl=300, show_spinner=False)  # Cache for 5 minutes
 def get_json(url):
-    """Fetch data from API and return as DataFrame"""
-    try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-
-        # Extract records from the API response
-        records = data.get('records', [])
-        if not records:
-            return pd.DataFrame()
-
-        # Convert to DataFrame
-        rows = []
-        for record in records:
-            fields = record.get('fields', {})
-            geometry = record.get('geometry', {})
-
-            # Add geometry coordinates if available
-            if geometry and 'coordinates' in geometry:
-                coords = geometry['coordinates']
-                fields['geo_point_2d'] = f"{coords[1]}, {coords[0]}"  # lat, lon format
-
-            rows.append(fields)
-
-        return pd.DataFrame(rows)
-    except Exception as e:
-        st.error(f"Error al cargar datos de {url}: {e}")
+    """Fetch data from API and return as DataFrame (raises on network errors)"""
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    data = response.json()
+
+    # Extract records from the API response
+    records = data.get('records', [])
+    if not records:
         return pd.DataFrame()
 
+    # Convert to DataFrame
+    rows = []
+    for record in records:
+        fields = record.get('fields', {})
+        geometry = record.get('geometry', {})
+
+        # Add geometry coordinates if available
+        if geometry and 'coordinates' in geometry:
+            coords = geometry['coordinates']
+            fields['geo_point_2d'] = f"{coords[1]}, {coords[0]}"  # lat, lon format
+
+        rows.append(fields)
+
+    df = pd.DataFrame(rows)
+
+    # Parse 'lat, lon' strings into numeric columns once for the whole dataset
+    if 'geo_point_2d' not in df:
+        df['geo_point_2d'] = None
+    latlon = df['geo_point_2d'].astype(str).str.split(',', n=1, expand=True).reindex(columns=[0, 1])
+    df['lat'] = pd.to_numeric(latlon[0], errors='coerce')
+    df['lon'] = pd.to_numeric(latlon[1], errors='coerce')
+
+    return df
+
 
 # Load data from APIs
-@st.cache_data(ttl=300, show_spinner=False)
+@st.cache_data(ttl=300, show_spinner=False)  # Cache for 5 minutes
 def load_data():
-    parkings = get_json(DATASETS["parkings"])
-    bikes = get_json(DATASETS["valenbisi"])
-    traffic = get_json(DATASETS["traffic"])
-    buses = get_json(DATASETS["buses"])
-    return buses, bikes, traffic, parkings
+    """Fetch all datasets concurrently; failed downloads are reported and returned empty.
+    Also returns the load time, which identifies this refresh for the map caches below."""
+    with ThreadPoolExecutor(max_workers=len(DATASETS)) as executor:
+        futures = {name: executor.submit(get_json, url) for name, url in DATASETS.items()}
+
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            st.error(f"Error al cargar datos de {DATASETS[name]}: {e}")
+            results[name] = pd.DataFrame()
+    return results["buses"], results["valenbisi"], results["traffic"], results["parkings"], time.time()
 
 
 # Load data
 with st.spinner("Cargando datos en tiempo real..."):
-    emt_df, bici_df, traffic_df, parkings_df = load_data()
+    emt_df, bici_df, traffic_df, parkings_df, loaded_at = load_data()
 
 # Check if data was loaded successfully
 if emt_df.empty or bici_df.empty or traffic_df.empty or parkings_df.empty:
@@ -81,195 +96,195 @@ if 'suprimida' in emt_df.columns:
 else:
     emt_suppressed_df = pd.DataFrame()
 
-# Define helper function to get lat, lon from geo_point string
-def parse_geo_point(point_str):
-    """Parse a 'lat, lon' string into a (lat, lon) tuple of floats."""
-    try:
-        if pd.isna(point_str):
+# Coerce numeric columns and derive display columns once, outside the marker loops
+def to_int(df, column):
+    """Return a column as ints, treating missing or non-numeric values as 0."""
+    if column not in df:
+        return pd.Series(0, index=df.index)
+    return pd.to_numeric(df[column], errors='coerce').fillna(0).astype(int)
+
+def availability_color(counts):
+    """Color counts as red (0), orange (1-2) or green (3 or more)."""
+    return np.select([counts == 0, counts <= 2], ['red', 'orange'], default='green')
+
+def text_column(df, column, default):
+    """Return a column as strings, falling back to a constant when it is missing."""
+    if column not in df:
+        return pd.Series(default, index=df.index)
+    return df[column].astype(str)
+
+def parse_shape(geo_shape):
+    """Return a geo_shape as a dict, decoding JSON strings; None when missing or invalid."""
+    if isinstance(geo_shape, dict):
+        return geo_shape
+    if isinstance(geo_shape, str):
+        try:
+            return orjson.loads(geo_shape)
+        except orjson.JSONDecodeError:
             return None
-        lat_str, lon_str = str(point_str).split(',')
-        return float(lat_str.strip()), float(lon_str.strip())
-    except Exception:
-        return None
+    return None
+
+def points_geojson(df, properties):
+    """Build a GeoJSON FeatureCollection of the rows with coordinates, carrying the given columns."""
+    df = df.dropna(subset=['lat', 'lon'])
+    columns = [df[p].tolist() for p in properties]
+    features = [
+        {"type": "Feature",
+         "geometry": {"type": "Point", "coordinates": [lon, lat]},
+         "properties": dict(zip(properties, values))}
+        for lat, lon, *values in zip(df['lat'].tolist(), df['lon'].tolist(), *columns)
+    ]
+    return {"type": "FeatureCollection", "features": features}
+
+def color_style(column, **style):
+    """Return a GeoJson style_function that colors each feature from one of its properties."""
+    return lambda feature: {"color": feature["properties"][column],
+                            "fillColor": feature["properties"][column], **style}
+
+emt_df['tooltip'] = text_column(emt_df, 'denominacion', 'Parada EMT') + " - Líneas: " + text_column(emt_df, 'lineas', '')
+
+bici_df['bikes'] = to_int(bici_df, 'available')
+bici_df['free_slots'] = to_int(bici_df, 'free')
+bici_df['bikes_color'] = availability_color(bici_df['bikes'])
+bici_df['free_color'] = availability_color(bici_df['free_slots'])
+bici_df['tooltip'] = (text_column(bici_df, 'address', 'Estación Valenbisi') + " - " + bici_df['bikes'].astype(str)
+                      + " bicis, " + bici_df['free_slots'].astype(str) + " libres")
+
+parkings_df['name'] = text_column(parkings_df, 'nombre', 'Parking')
+parkings_df['total_spots'] = np.trunc(pd.to_numeric(text_column(parkings_df, 'plazastota', ''), errors='coerce')).astype('Int64')
+parkings_df['popup'] = (parkings_df['name'] + " - "
+                        + parkings_df['total_spots'].astype(str).where(parkings_df['total_spots'].notna(), "N/D")
+                        + " plazas totales")
+
+traffic_df['shape'] = traffic_df['geo_shape'].map(parse_shape) if 'geo_shape' in traffic_df else None
+traffic_state = to_int(traffic_df, 'estado')
+traffic_df['color'] = np.select([traffic_state == 0, traffic_state == 1, traffic_state >= 2],
+                                ['green', 'orange', 'red'], default='gray')
+
+# Client-side marker factory for the EMT cluster: row is [lat, lon, tooltip]
+EMT_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'bus', prefix: 'fa', markerColor: 'red'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindTooltip(row[2]);
+    return marker;
+}
+"""
 
+# Use a central point in Valencia for initial view (Plaza del Ayuntamiento coordinates)
+VALENCIA_CENTER = [39.4699, -0.3763]
 
-# Create the tab layout
-tab1, tab2, tab3 = st.tabs(["🌍 Mapa principal", "🚫 Paradas EMT suprimidas", "🚲 Valenbisi"])
 
-# --- Tab 1: Main Map ---
-with tab1:
-    # Build the main map with folium
-    # Use a central point in Valencia for initial view (e.g., Plaza del Ayuntamiento coordinates)
-    valencia_center = [39.4699, -0.3763]
-    main_map = folium.Map(location=valencia_center, zoom_start=13)
+# Map builders, cached per data refresh so unrelated reruns (e.g. the tab 3 radio) reuse the HTML.
+# Only loaded_at is hashed: the underscore-prefixed frames are derived from that load and would
+# otherwise be pickled on every rerun (their dict columns defeat Streamlit's hasher).
+@st.cache_data(ttl=300, max_entries=2, show_spinner=False)
+def build_main_map(loaded_at, _emt_df, _bici_df, _traffic_df, _parkings_df):
+    """Build the layered main map and return its HTML."""
+    main_map = folium.Map(location=VALENCIA_CENTER, zoom_start=13)
 
     # Layer: EMT stops (clustered markers) - OFF by default
-    emt_layer = MarkerCluster(name="Paradas EMT", control=True, show=False)
-    for _, row in emt_df.iterrows():
-        coords = parse_geo_point(row.get('geo_point_2d'))
-        if not coords:
-            continue
-        lat, lon = coords
-
-        # Use a bus icon for bus stops
-        icon = folium.Icon(color="red", icon="bus", prefix="fa")
+    emt_stops = _emt_df.dropna(subset=['lat', 'lon'])[['lat', 'lon', 'tooltip']].values.tolist()
+    FastMarkerCluster(emt_stops, callback=EMT_MARKER_CALLBACK, name="Paradas EMT", control=True,
+                      show=False).add_to(main_map)
 
-        # Tooltip with stop name and lines
-        stop_name = str(row.get('denominacion', 'Parada EMT'))
-        lines = str(row.get('lineas', ''))
-        tooltip = f"{stop_name} - Líneas: {lines}"
+    # Layer: Valenbisi stations (colored circle markers by bikes availability)
+    folium.GeoJson(
+        points_geojson(_bici_df, ['bikes_color', 'tooltip']),
+        name="Estaciones Valenbisi",
+        show=False,
+        marker=folium.CircleMarker(radius=6, fill=True, fill_opacity=0.8),
+        style_function=color_style('bikes_color'),
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False),
+    ).add_to(main_map)
 
-        folium.Marker(location=[lat, lon], icon=icon, tooltip=tooltip).add_to(emt_layer)
-    emt_layer.add_to(main_map)
+    # Layer: Traffic status (lines with color by state) - ON by default
+    # Each shape is a LineString (list of [lon, lat]), already in GeoJSON order
+    traffic_features = [
+        {"type": "Feature", "geometry": shape, "properties": {"color": color}}
+        for shape, color in zip(_traffic_df['shape'], _traffic_df['color'])
+        if shape and shape.get('coordinates')
+    ]
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": traffic_features},
+        name="Tráfico (estado)",
+        show=True,
+        style_function=color_style('color', weight=5, opacity=0.7),
+    ).add_to(main_map)
 
-    # Layer: Valenbisi stations (colored circle markers by bikes availability)
-    bici_layer = folium.FeatureGroup(name="Estaciones Valenbisi", show=False)
-    for _, row in bici_df.iterrows():
-        coords = parse_geo_point(row.get('geo_point_2d'))
-        if not coords:
-            continue
-        lat, lon = coords
-
-        bikes = 0
-        try:
-            bikes = int(row.get('available', 0))
-        except (ValueError, TypeError):
-            bikes = 0
-
-        # Color coding for bikes available
-        if bikes == 0:
-            color = 'red'
-        elif bikes <= 2:
-            color = 'orange'
-        else:
-            color = 'green'
-
-        # Circle marker with tooltip showing station info
-        station_name = str(row.get('address', 'Estación Valenbisi'))
-        free_slots = 0
-        try:
-            free_slots = int(row.get('free', 0))
-        except (ValueError, TypeError):
-            free_slots = 0
-        tooltip = f"{station_name} - {bikes} bicis, {free_slots} libres"
+    # Layer: Public parkings (markers with 'P' icon) - ON by default
+    folium.GeoJson(
+        points_geojson(_parkings_df, ['name', 'popup']),
+        name="Parkings públicos",
+        show=True,
+        marker=folium.Marker(icon=folium.Icon(color="blue", icon="car", prefix="fa")),
+        tooltip=folium.GeoJsonTooltip(fields=['name'], labels=False),
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False),
+    ).add_to(main_map)
 
-        folium.CircleMarker(location=[lat, lon], radius=6, color=color, fill=True,
-                            fill_color=color, fill_opacity=0.8, tooltip=tooltip).add_to(bici_layer)
-    bici_layer.add_to(main_map)
+    # Add a layer control to toggle layers
+    folium.LayerControl(collapsed=False).add_to(main_map)
 
-    # Layer: Traffic status (lines with color by state) - ON by default
-    traffic_layer = folium.FeatureGroup(name="Tráfico (estado)", show=True)
-    for _, row in traffic_df.iterrows():
-        geo_shape = row.get('geo_shape')
-        if pd.isna(geo_shape):
-            continue
+    return main_map.get_root().render()
 
-        try:
-            if isinstance(geo_shape, str):
-                shape = json.loads(geo_shape)
-            else:
-                shape = geo_shape
-        except:
-            continue
 
-        coords_list = shape.get('coordinates', [])
-        if not coords_list:
-            continue
+@st.cache_data(ttl=300, max_entries=4, show_spinner=False)
+def build_valenbisi_map(loaded_at, _bici_df, color_column):
+    """Build the Valenbisi stations map colored by the given column and return its HTML."""
+    valenbisi_map = folium.Map(location=VALENCIA_CENTER, zoom_start=13)
 
-        # Each coords_list is a LineString (list of [lon, lat])
-        line_coords = [(pt[1], pt[0]) for pt in coords_list]
+    folium.GeoJson(
+        points_geojson(_bici_df, [color_column, 'tooltip']),
+        marker=folium.CircleMarker(radius=7, fill=True, fill_opacity=0.9),
+        style_function=color_style(color_column),
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False),
+    ).add_to(valenbisi_map)
 
-        state = 0
-        try:
-            state = int(row.get('estado', 0))
-        except (ValueError, TypeError):
-            state = 0
-
-        # Determine line color based on traffic state
-        if state == 0:
-            line_color = "green"
-        elif state == 1:
-            line_color = "orange"
-        elif state >= 2:
-            line_color = "red"
-        else:
-            line_color = "gray"
-
-        folium.PolyLine(locations=line_coords, color=line_color, weight=5, opacity=0.7).add_to(traffic_layer)
-    traffic_layer.add_to(main_map)
+    return valenbisi_map.get_root().render()
 
-    # Layer: Public parkings (markers with 'P' icon) - ON by default
-    parking_layer = folium.FeatureGroup(name="Parkings públicos", show=True)
-    for _, row in parkings_df.iterrows():
-        coords = parse_geo_point(row.get('geo_point_2d'))
-        if not coords:
-            continue
-        lat, lon = coords
 
-        parking_name = str(row.get('nombre', 'Parking'))
-        total_spots = row.get('plazastota', 'N/D')
+@st.cache_data(ttl=300, max_entries=2, show_spinner=False)
+def build_suppressed_tab(loaded_at, _emt_suppressed_df):
+    """Return the table of suppressed stops and the HTML of a map showing them."""
+    table = (_emt_suppressed_df
+             .reindex(columns=['id_parada', 'denominacion', 'lineas'], fill_value='N/D')
+             .rename(columns={'id_parada': 'ID Parada', 'denominacion': 'Denominación', 'lineas': 'Líneas'})
+             .reset_index(drop=True))
 
-        # Safe conversion to int
-        try:
-            if pd.notna(total_spots) and str(total_spots).strip() != '':
-                total_spots = int(float(str(total_spots)))
-            else:
-                total_spots = "N/D"
-        except (ValueError, TypeError):
-            total_spots = "N/D"
+    supp_map = folium.Map(location=VALENCIA_CENTER, zoom_start=12)
+    stops = _emt_suppressed_df.assign(
+        tooltip=text_column(_emt_suppressed_df, 'denominacion', 'Parada suprimida') + " (Fuera de servicio)")
+    folium.GeoJson(
+        points_geojson(stops, ['tooltip']),
+        marker=folium.Marker(icon=folium.Icon(color="red", icon="ban", prefix="fa")),
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False),
+    ).add_to(supp_map)
+    folium.LayerControl().add_to(supp_map)
 
-        icon = folium.Icon(color="blue", icon="car", prefix="fa")
-        popup_text = f"{parking_name} - {total_spots} plazas totales"
+    return table, supp_map.get_root().render()
 
-        folium.Marker(location=[lat, lon], icon=icon, popup=popup_text, tooltip=parking_name).add_to(parking_layer)
-    parking_layer.add_to(main_map)
 
-    # Add a layer control to toggle layers
-    folium.LayerControl(collapsed=False).add_to(main_map)
+# Create the tab layout
+tab1, tab2, tab3 = st.tabs(["🌍 Mapa principal", "🚫 Paradas EMT suprimidas", "🚲 Valenbisi"])
 
+# --- Tab 1: Main Map ---
+with tab1:
     # Display the map
-    st.components.v1.html(main_map._repr_html_(), height=760)
+    st.iframe(build_main_map(loaded_at, emt_df, bici_df, traffic_df, parkings_df), height=760)
 
 # --- Tab 2: Suppressed EMT Stops ---
 with tab2:
     if emt_suppressed_df.empty:
         st.info("Actualmente no hay paradas suprimidas.")
     else:
-        # Display a table of suppressed stops
-        display_data = []
-        for _, row in emt_suppressed_df.iterrows():
-            stop_id = row.get('id_parada', 'N/D')
-            stop_name = row.get('denominacion', 'N/D')
-            lines = row.get('lineas', 'N/D')
-
-            display_data.append({
-                'ID Parada': stop_id,
-                'Denominación': stop_name,
-                'Líneas': lines
-            })
+        df_display, supp_map_html = build_suppressed_tab(loaded_at, emt_suppressed_df)
 
         # Show table
-        df_display = pd.DataFrame(display_data)
         st.dataframe(df_display, use_container_width=True)
 
-        # Create a map showing these stops
-        supp_map = folium.Map(location=valencia_center, zoom_start=12)
-        for _, row in emt_suppressed_df.iterrows():
-            coords = parse_geo_point(row.get('geo_point_2d'))
-            if not coords:
-                continue
-            lat, lon = coords
-
-            stop_name = str(row.get('denominacion', 'Parada suprimida'))
-
-            folium.Marker(location=[lat, lon],
-                          icon=folium.Icon(color="red", icon="ban", prefix="fa"),
-                          tooltip=f"{stop_name} (Fuera de servicio)").add_to(supp_map)
-
-        folium.LayerControl().add_to(supp_map)
-
         # Show the map
-        st.components.v1.html(supp_map._repr_html_(), height=760)
+        st.iframe(supp_map_html, height=760)
 
 # --- Tab 3: Valenbisi Stations ---
 with tab3:
@@ -282,46 +297,8 @@ with tab3:
     else:
         st.markdown("**Colores:** rojo = 0 espacios libres, naranja = 1-2 espacios, verde = 3 o más espacios libres.")
 
-    # Build map of Valenbisi stations
-    valenbisi_map = folium.Map(location=valencia_center, zoom_start=13)
-
-    for _, row in bici_df.iterrows():
-        coords = parse_geo_point(row.get('geo_point_2d'))
-        if not coords:
-            continue
-        lat, lon = coords
-
-        bikes = 0
-        free = 0
-        try:
-            bikes = int(row.get('available', 0))
-        except (ValueError, TypeError):
-            bikes = 0
-        try:
-            free = int(row.get('free', 0))
-        except (ValueError, TypeError):
-            free = 0
-
-        # Determine value based on selected criterion
-        if criterion == "Bicis disponibles":
-            value = bikes
-        else:
-            value = free
-
-        # Color based on value thresholds
-        if value == 0:
-            color = 'red'
-        elif value <= 2:
-            color = 'orange'
-        else:
-            color = 'green'
-
-        # Tooltip with station details
-        station = str(row.get('adress', 'Estación Valenbisi'))
-        tooltip = f"{station} - {bikes} bicis, {free} libres"
-
-        folium.CircleMarker(location=[lat, lon], radius=7, color=color, fill=True,
-                            fill_color=color, fill_opacity=0.9, tooltip=tooltip).add_to(valenbisi_map)
+    # Color column based on selected criterion
+    color_column = 'bikes_color' if criterion == "Bicis disponibles" else 'free_color'
 
     # Show the map of Valenbisi
-    st.components.v1.html(valenbisi_map._repr_html_(), height=625)
+    st.iframe(build_valenbisi_map(loaded_at, bici_df, color_column), height=625)
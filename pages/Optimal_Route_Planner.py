@@ -1,12 +1,23 @@
 import streamlit as st
 import folium
-from streamlit_folium import st_folium
 import requests
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+from urllib.parse import urlparse
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from geopy.geocoders import Nominatim, Photon
 import openrouteservice
-from heapq import nsmallest
+import numpy as np
+from scipy.spatial import cKDTree
+import math
+import re
+import unicodedata
+import copy
 import time
+import threading
+from collections import deque
+import diskcache
+from concurrent.futures import ThreadPoolExecutor
 
 # ----------------------------------------------------------------------------------------------------------------------
 # GENERAL CONFIGURATION
@@ -14,169 +25,507 @@ import time
 st.set_page_config(page_title="Optimal Route Planner in Valencia", page_icon="🗺️", layout="wide", initial_sidebar_state="expanded")
 
 ORS_API_KEY = st.secrets["ORS_API_KEY"]
-ors_client = openrouteservice.Client(key=ORS_API_KEY)
-
-geolocator = Nominatim(user_agent="route_planner_valencia")
 
+# A self-hosted Photon (e.g. "http://localhost:2322") avoids the public Nominatim round trip and its rate limit
+GEOCODER_URL = st.secrets.get("GEOCODER_URL")
+if GEOCODER_URL:
+    geocoder_url = urlparse(GEOCODER_URL)
+    geolocator = Photon(scheme=geocoder_url.scheme, domain=geocoder_url.netloc, user_agent="route_planner_valencia")
+else:
+    geolocator = Nominatim(user_agent="route_planner_valencia")
+
+# Valencia bounding box as (lat, lon) corners; geocoding matches outside it are discarded
+VALENCIA_VIEWBOX = [(39.42, -0.45), (39.52, -0.30)]
+
+def normalize_address(address: str):
+    """Return the geocode cache key for an address, ignoring case, accents, spacing and a trailing ", Valencia"."""
+    # Drop only the combining accents, so non-Latin scripts keep their own distinct keys
+    key = "".join(c for c in unicodedata.normalize("NFKD", address) if not unicodedata.combining(c)).lower()
+    key = re.sub(r"\s+", " ", key).strip(" ,")
+    return re.sub(r"\s*,\s*valencia$", "", key)
+
+# Default addresses, pre-resolved so a new session's first route needs no geocoder call
+DEFAULT_START = "Plaza del Ayuntamiento, Valencia"
+DEFAULT_END = "Ciudad de las Artes y las Ciencias, Valencia"
+KNOWN_ADDRESSES = {
+    normalize_address(DEFAULT_START): (39.4699, -0.3763),
+    normalize_address(DEFAULT_END): (39.4549, -0.3506),
+}
+
+# Open connections to the tile server and folium's CDNs while the map HTML is still on its way
 st.markdown("""
 <style>
 header { visibility: hidden; }
 </style>
+<link rel="preconnect" href="https://tile.openstreetmap.org">
+<link rel="preconnect" href="https://cdn.jsdelivr.net">
+<link rel="preconnect" href="https://cdnjs.cloudflare.com">
+<link rel="preconnect" href="https://code.jquery.com">
 """, unsafe_allow_html=True)
 
 # ----------------------------------------------------------------------------------------------------------------------
 # CACHED HELPERS
 # ----------------------------------------------------------------------------------------------------------------------
-@st.cache_data(show_spinner=False)
+@st.cache_resource
+def get_geocode_cache():
+    """Return the on-disk geocode cache shared across sessions and server restarts."""
+    return diskcache.Cache(".cache/geocode")
+
+@st.cache_resource
+def get_nominatim_throttle():
+    """Return the lock and last-call timestamp used to keep Nominatim at 1 request/second."""
+    return {"lock": threading.Lock(), "last": 0.0}
+
+def query_geocoder(address: str):
+    """Look an address up within Valencia, spacing public Nominatim calls at least 1 s apart."""
+    if GEOCODER_URL:
+        return geolocator.geocode(address, timeout=10, bbox=VALENCIA_VIEWBOX)
+
+    throttle = get_nominatim_throttle()
+    with throttle["lock"]:
+        wait = 1.0 - (time.monotonic() - throttle["last"])
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            return geolocator.geocode(address, timeout=10, viewbox=VALENCIA_VIEWBOX, bounded=True)
+        finally:
+            throttle["last"] = time.monotonic()
+
 def geocode(address: str):
     """Return (lat, lon) tuple for a street address or None if not found."""
-    try:
-        loc = geolocator.geocode(address, timeout=10)
-        return (loc.latitude, loc.longitude) if loc else None
-    except Exception:
+    key = normalize_address(address)
+    if not key:
         return None
+    return geocode_normalized(key, address)
+
+# The leading underscore keeps the raw address out of the cache key, so spelling variants share one entry
+@st.cache_data(show_spinner=False)
+def geocode_normalized(key: str, _address: str):
+    """Return (lat, lon) for a normalized address key, querying the geocoder with the address as typed."""
+    if key in KNOWN_ADDRESSES:
+        return KNOWN_ADDRESSES[key]
+
+    cache = get_geocode_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
 
-@st.cache_data(ttl=300, show_spinner=False)
-def get_json(url: str):
-    """Download JSON from an open data endpoint and return list of records, empty list on error."""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return response.json().get("records", [])
+        loc = query_geocoder(_address)
     except Exception:
-        return []
-
+        return None
+    if not loc:
+        return None
+    result = (loc.latitude, loc.longitude)
+    cache.set(key, result, expire=30 * 86400)
+    return result
+
+@st.cache_resource
+def get_http_session():
+    """Return a keep-alive session for the open data portal, retrying transient failures."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.3)))
+    return session
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def get_json(url: str, window: int):
+    """Download JSON from an open data endpoint and return its list of records (raises on error).
+    window only versions the cache key, so each dataset expires on its own TTL (see data_window)."""
+    response = get_http_session().get(url, timeout=10)
+    response.raise_for_status()
+    return orjson.loads(response.content).get("records", [])
+
+@st.cache_resource
+def get_last_good():
+    """Return the lock and per-index state behind latest(): last good value, its window, retry time and in-flight build."""
+    return {"lock": threading.Lock(), "indexes": {}}
+
+@st.cache_resource
+def get_refresh_executor():
+    """Return the pool rebuilding expired dataset indexes in the background."""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="refresh")
+
+@st.cache_resource
+def get_ors_client():
+    """Return an ORS client whose pooled HTTPS session is reused across reruns and worker threads."""
+    client = openrouteservice.Client(key=ORS_API_KEY)
+    client._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return client
+
+@st.cache_resource
+def get_executor():
+    """Return the thread pool shared across sessions for overlapping ORS requests."""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_prefetch_executor():
+    """Return the small pool for speculative route prefetches, kept apart so they never delay requested routes."""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+
+ORS_DIRECTIONS_PER_MINUTE = 40  # free-tier quota
+
+@st.cache_resource
+def get_ors_limiter():
+    """Return the lock and timestamps of recent ORS directions calls, shared by every session and thread."""
+    return {"lock": threading.Lock(), "calls": deque()}
+
+def prune_ors_calls(calls, now):
+    """Drop the timestamps that fell out of the one-minute quota window."""
+    while calls and now - calls[0] >= 60:
+        calls.popleft()
+
+def wait_for_ors_quota():
+    """Block only while the last minute already holds ORS_DIRECTIONS_PER_MINUTE directions calls."""
+    limiter = get_ors_limiter()
+    calls = limiter["calls"]
+    with limiter["lock"]:
+        while True:
+            now = time.monotonic()
+            prune_ors_calls(calls, now)
+            if len(calls) < ORS_DIRECTIONS_PER_MINUTE:
+                calls.append(now)
+                return
+            time.sleep(60 - (now - calls[0]))
+
+def ors_has_headroom():
+    """Return True while under half the ORS quota was used in the last minute, without waiting on the limiter."""
+    limiter = get_ors_limiter()
+    # A held lock usually means a caller is waiting for quota, which is no headroom at all
+    if not limiter["lock"].acquire(blocking=False):
+        return False
+    try:
+        prune_ors_calls(limiter["calls"], time.monotonic())
+        return len(limiter["calls"]) < ORS_DIRECTIONS_PER_MINUTE // 2
+    finally:
+        limiter["lock"].release()
+
+@st.cache_resource
+def get_route_cache():
+    """Return the on-disk ORS route cache shared across sessions and server restarts."""
+    return diskcache.Cache(".cache/routes")
+
+# st.cache_data computes each key under its own lock, so overlapping reruns and prefetches
+# asking for the same leg wait for one ORS call instead of issuing duplicates
 @st.cache_data(show_spinner=False)
+def fetch_route(coords, profile="foot-walking"):
+    """Return a GeoJSON route for the given list of coordinates from disk or OpenRouteService (raises on error)."""
+    key = (tuple(map(tuple, coords)), profile)
+    route = get_route_cache().get(key)
+    if route is not None:
+        return route
+
+    wait_for_ors_quota()
+    response = get_ors_client().directions(coordinates=coords, profile=profile, format="geojson")
+    # Keep only the geometry and summary: turn-by-turn steps and metadata would otherwise be
+    # copied out of the cache on every hit and serialized into the map HTML.
+    # 5 decimals (~1 m) is plenty for drawing and shortens every coordinate in the HTML.
+    route = {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature",
+             "geometry": {"type": f["geometry"]["type"],
+                          "coordinates": np.round(np.asarray(f["geometry"]["coordinates"], dtype=float), 5).tolist()},
+             "properties": {"summary": f["properties"]["summary"]}}
+            for f in response["features"]
+        ],
+    }
+    get_route_cache().set(key, route, expire=7 * 86400)
+    return route
+
+def get_routes(*legs):
+    """Fetch several (coords, profile) legs concurrently; failed legs are reported and returned as None."""
+    futures = [get_executor().submit(fetch_route, coords, profile) for coords, profile in legs]
+    routes = []
+    for future in futures:
+        try:
+            routes.append(future.result())
+        except Exception as e:
+            st.error(f"Error getting route: {str(e)}")
+            routes.append(None)
+    return routes
+
 def get_route(coords, profile="foot-walking"):
-    """Call OpenRouteService and return a GeoJSON route for the given list of coordinates."""
-    try:
-        # Add small delay to avoid rate limiting
-        time.sleep(0.1)
-        return ors_client.directions(coordinates=coords, profile=profile, format="geojson")
-    except Exception as e:
-        st.error(f"Error getting route: {str(e)}")
-        return None
+    """Return a GeoJSON route for the given list of coordinates or None on error."""
+    return get_routes((coords, profile))[0]
+
+def cancel_prefetch():
+    """Cancel route prefetches that have not started yet."""
+    future = st.session_state.pop("prefetch", None)
+    if future and not future.cancel() and future.done() and future.exception() is None:
+        for leg in future.result():
+            leg.cancel()
 
 # ----------------------------------------------------------------------------------------------------------------------
 # HELPER FUNCTIONS
 # ----------------------------------------------------------------------------------------------------------------------
+def lonlat(point):
+    """Swap a (lat, lon) point into the (lon, lat) order ORS expects, rounded to ~1 m so route cache keys match."""
+    return (round(point[1], 5), round(point[0], 5))
+
+@st.cache_resource
+def get_base_map(zoom):
+    """Build the bare folium map for a zoom level; shared, so never add layers to it or move it."""
+    return folium.Map(location=[39.4699, -0.3763], zoom_start=zoom, prefer_canvas=True)
+
+def new_map(center, zoom):
+    """Return a private copy of the cached base map for the zoom, centered on a (lat, lon) point."""
+    m = copy.deepcopy(get_base_map(zoom))
+    m.location = [center[0], center[1]]
+    return m
+
+@st.cache_resource(max_entries=64)
+def get_endpoints_map(start_coords, end_coords, start_label, end_label):
+    """Build the map framing a start/end pair with both markers; shared, so never add layers to it."""
+    # Calculate center point
+    center = [(start_coords[0] + end_coords[0]) / 2, (start_coords[1] + end_coords[1]) / 2]
+    
+    # Create map with good zoom level
+    distance_km = haversine_m([start_coords], end_coords)[0] / 1000
+    if distance_km < 2:
+        zoom = 15
+    elif distance_km < 5:
+        zoom = 14
+    elif distance_km < 10:
+        zoom = 13
+    else:
+        zoom = 12
+    
+    m = new_map(center, zoom)
+    
+    # Add start and end markers
+    folium.Marker(
+        start_coords, 
+        tooltip="Start Point", 
+        popup=start_label,
+        icon=folium.Icon(color="green", icon="play")
+    ).add_to(m)
+    
+    folium.Marker(
+        end_coords, 
+        tooltip="End Point", 
+        popup=end_label,
+        icon=folium.Icon(color="red", icon="stop")
+    ).add_to(m)
+
+    return m
+
 def draw_route(m, route_geojson, color, name="Route", weight=5):
     """Add a colored route to the folium map with proper styling."""
     if route_geojson and "features" in route_geojson and route_geojson["features"]:
-        folium.GeoJson(
-            route_geojson,
-            name=name,
-            style_function=lambda feature: {
-                "color": color, 
-                "weight": weight,
-                "opacity": 0.8,
-                "fillOpacity": 0.3
-            },
+        # A plain polyline skips Leaflet's GeoJSON parser and the serialized style callback
+        latlon = np.asarray(route_geojson["features"][0]["geometry"]["coordinates"], dtype=float)[:, 1::-1]
+        latlon = latlon[simplify_mask(to_local_xy(latlon))]
+        folium.PolyLine(
+            locations=latlon.tolist(),
+            color=color,
+            weight=weight,
+            opacity=0.8,
             tooltip=name
         ).add_to(m)
 
-def find_closest(records, ref_coords):
-    """Return the record whose geo_point_2d is closest (in meters) to ref_coords."""
-    if not records or not ref_coords:
+# Equirectangular projection around Valencia, accurate to well under 1 % at city scale
+M_PER_DEG_LAT = 110540
+M_PER_DEG_LON = 111320 * math.cos(math.radians(39.4699))
+EARTH_RADIUS_M = 6371008.8
+
+def to_local_xy(latlon):
+    """Project a sequence of (lat, lon) pairs to an (N, 2) array of local x/y meters."""
+    latlon = np.asarray(latlon, dtype=float).reshape(-1, 2)
+    return np.column_stack((latlon[:, 1] * M_PER_DEG_LON, latlon[:, 0] * M_PER_DEG_LAT))
+
+def haversine_m(latlon, ref_coords):
+    """Return great-circle distances in meters from each (lat, lon) pair to ref_coords."""
+    lat, lon = np.radians(np.asarray(latlon, dtype=float).reshape(-1, 2)).T
+    ref_lat, ref_lon = np.radians(ref_coords)
+    a = np.sin((lat - ref_lat) / 2) ** 2 + np.cos(lat) * np.cos(ref_lat) * np.sin((lon - ref_lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def simplify_mask(xy, tolerance_m=5):
+    """Return a mask of the vertices kept by Ramer-Douglas-Peucker simplification of an (N, 2) x/y meter path."""
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = xy[last] - xy[first]
+        rel = xy[first + 1:last] - xy[first]
+        length = math.hypot(dx, dy)
+        if length:
+            dist = np.abs(dx * rel[:, 1] - dy * rel[:, 0]) / length
+        else:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance_m:
+            keep[first + 1 + i] = True
+            stack += [(first, first + 1 + i), (first + 1 + i, last)]
+    return keep
+
+def find_closest(index, ref_coords):
+    """Return the fields of the indexed record closest (in meters) to ref_coords."""
+    tree, _, fields = index
+    if tree is None or not ref_coords:
         return None
-    
-    best, best_d = None, float("inf")
-    for rec in records:
-        fields = rec.get("fields", {})
-        coords = fields.get("geo_point_2d")
-        if coords and len(coords) == 2:
-            try:
-                d = geodesic(ref_coords, coords).meters
-                if d < best_d:
-                    best, best_d = fields, d
-            except Exception:
-                continue
-    return best
-
-def traffic_penalty_seconds(route_geojson, traffic_records, radius_m=50):
+    _, i = tree.query(to_local_xy([ref_coords])[0])
+    return fields[i]
+
+def traffic_penalty_seconds(route_geojson, traffic_index, radius_m=50):
     """
     Estimate extra travel time due to traffic around the route.
     For every 100 vehicles/hour average intensity near the path add 60 s.
     """
-    if not route_geojson or not traffic_records:
+    tree, intensities = traffic_index
+    if not route_geojson or tree is None:
         return 0
     
     try:
-        coords = route_geojson["features"][0]["geometry"]["coordinates"]
-        intensities = []
-        for rec in traffic_records:
-            fields = rec.get("fields", {})
-            tcoord = fields.get("geo_point_2d")
-            inten = fields.get("intensidad")
-            if tcoord and inten is not None:
-                try:
-                    inten = float(inten)
-                except ValueError:
-                    continue
-                # subsample coords for speed
-                for lon, lat in coords[::5]:
-                    if geodesic((lat, lon), tcoord).meters < radius_m:
-                        intensities.append(inten)
-                        break
-        if not intensities:
+        coords = np.asarray(route_geojson["features"][0]["geometry"]["coordinates"], dtype=float)[:, :2]
+        # Dense stretches repeat nearly the same vertex; a ~10 m grid is far finer than radius_m
+        coords = np.unique(np.round(coords, 4), axis=0)
+        # Every traffic point within radius_m of any route vertex counts once
+        hits = tree.query_ball_point(to_local_xy(coords[:, ::-1]), r=radius_m)
+        near = set().union(*hits)
+        if not near:
             return 0
-        avg_inten = sum(intensities) / len(intensities)
-        return (avg_inten / 100) * 60  # seconds
+        return (intensities[list(near)].mean() / 100) * 60  # seconds
     except Exception:
         return 0
 
-def k_closest(records, ref_coords, k=20):
-    """Return k nearest stop field dicts to ref_coords based on straight-line distance."""
-    if not records or not ref_coords:
-        return []
-    
-    valid_records = []
-    for rec in records:
-        fields = rec.get("fields", {})
-        if fields.get("geo_point_2d"):
-            valid_records.append(fields)
-    
-    if not valid_records:
+def k_closest(index, ref_coords, k=8):
+    """Return positions of the k indexed records nearest to ref_coords based on straight-line distance."""
+    tree, _, fields = index
+    if tree is None or not ref_coords:
         return []
-    
-    return nsmallest(
-        k,
-        valid_records,
-        key=lambda f: geodesic(ref_coords, f["geo_point_2d"]).meters
-    )
-
-def common_lines(stop_a: dict, stop_b: dict) -> set[str]:
-    """Return set of EMT bus lines that both stops share."""
-    sa = {l.strip() for l in stop_a.get("lineas", "").split(",") if l.strip()}
-    sb = {l.strip() for l in stop_b.get("lineas", "").split(",") if l.strip()}
-    return sa & sb
+    _, idx = tree.query(to_local_xy([ref_coords])[0], k=min(k, len(fields)))
+    return np.atleast_1d(idx).tolist()
 
 # ----------------------------------------------------------------------------------------------------------------------
 # LOAD DATA
 # ----------------------------------------------------------------------------------------------------------------------
-@st.cache_data(ttl=300, show_spinner="Loading Valencia data...")
-def load_all_data():
-    """Load all datasets at once to improve performance."""
-    DATASETS = {
-        "parkings": "https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=parkings&rows=1000",
-        "valenbisi": "https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=valenbisi-disponibilitat-valenbisi-dsiponibilidad&rows=1000",
-        "traffic": "https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=estat-transit-temps-real-estado-trafico-tiempo-real&rows=1000",
-        "buses": "https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=emt&rows=5000",
-    }
-    
-    return {
-        "parkings": get_json(DATASETS["parkings"]),
-        "bikes": get_json(DATASETS["valenbisi"]),
-        "traffic": get_json(DATASETS["traffic"]),
-        "buses": get_json(DATASETS["buses"]),
-    }
+# Each dataset is only downloaded (via the cached get_json) the first time a mode needs it.
+# (url, ttl seconds): stops and garages rarely change, bike availability and traffic are real time.
+DATASETS = {
+    "parkings": ("https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=parkings&rows=1000", 3600),
+    "bikes": ("https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=valenbisi-disponibilitat-valenbisi-dsiponibilidad&rows=1000", 300),
+    "traffic": ("https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=estat-transit-temps-real-estado-trafico-tiempo-real&rows=1000", 60),
+    "buses": ("https://valencia.opendatasoft.com/api/records/1.0/search/?dataset=emt&rows=5000", 86400),
+}
+
+def data_window(dataset: str) -> int:
+    """Return the index of the dataset's current TTL window; cache keys built on it roll over on expiry."""
+    return int(time.time() // DATASETS[dataset][1])
+
+# After a failed download, serve what we have for this long before trying the feed again
+REFRESH_BACKOFF = 30
+
+def latest(name, build, dataset, empty):
+    """
+    Return build(window) for the dataset's current window.
+    Once an index has loaded, expired windows are rebuilt in the background while the last good value is
+    served, so an outage never blocks the page; failed builds are retried after REFRESH_BACKOFF seconds.
+    Until the first load succeeds there is nothing to serve, so callers wait for the build in flight.
+    """
+    last_good = get_last_good()
+    window = data_window(dataset)
+    with last_good["lock"]:
+        state = last_good["indexes"].setdefault(
+            name, {"value": empty, "window": None, "retry_at": 0.0, "loading": None})
+        loaded = state["window"] is not None
+        loading = state["loading"]
+        if state["window"] == window or time.monotonic() < state["retry_at"] or (loading and loaded):
+            return state["value"]
+        if loading is None:
+            loading = state["loading"] = threading.Event()
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        loading.wait()
+        return state["value"]
+
+    def refresh():
+        built = False
+        try:
+            value = build(window)
+            built = True
+        except Exception:
+            pass
+        finally:
+            # Also runs on BaseException, so the index can never stay marked as loading
+            with last_good["lock"]:
+                if built:
+                    state.update(value=value, window=window)
+                else:
+                    state["retry_at"] = time.monotonic() + REFRESH_BACKOFF
+                state["loading"] = None
+            loading.set()
+
+    if loaded:
+        get_refresh_executor().submit(refresh)
+    else:
+        refresh()
+    return state["value"]
 
-# Load data
-data = load_all_data()
-parkings = data["parkings"]
-bikes = data["bikes"]
-traffic = data["traffic"]
-buses = data["buses"]
+EMPTY_INDEX = (None, np.empty((0, 2)), [])
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def build_spatial_index(dataset: str, window: int):
+    """
+    Index a dataset's records with a valid geo_point_2d.
+    Return (tree, latlon, fields): a KD-tree over projected meters, the contiguous (N, 2) lat/lon array
+    and the field dicts, all sharing row positions; tree is None if the dataset is empty.
+    """
+    fields = [
+        rec.get("fields", {}) for rec in get_json(DATASETS[dataset][0], window)
+        if len(rec.get("fields", {}).get("geo_point_2d") or []) == 2
+    ]
+    if not fields:
+        return EMPTY_INDEX
+    latlon = np.array([f["geo_point_2d"] for f in fields], dtype=float)
+    return cKDTree(to_local_xy(latlon)), latlon, fields
+
+def get_spatial_index(dataset: str):
+    """Return the current (tree, latlon, fields) index of a dataset."""
+    return latest(f"spatial:{dataset}", lambda window: build_spatial_index(dataset, window), dataset, EMPTY_INDEX)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def build_bus_lines_index(window: int):
+    """Return (index, stop_lines, line_stops): the bus stop KD-tree index, each stop's lines and each line's stops."""
+    index = build_spatial_index("buses", window)
+    _, _, fields = index
+    stop_lines = [frozenset(l.strip() for l in f.get("lineas", "").split(",") if l.strip()) for f in fields]
+    line_stops = {}
+    for i, lines in enumerate(stop_lines):
+        for line in lines:
+            line_stops.setdefault(line, set()).add(i)
+    return index, stop_lines, line_stops
+
+def get_bus_lines_index():
+    """Return the current bus stop index with its line memberships."""
+    return latest("bus_lines", build_bus_lines_index, "buses", (EMPTY_INDEX, [], {}))
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def build_traffic_index(window: int):
+    """Build a KD-tree over traffic sensors with a numeric intensity; return (tree, intensities)."""
+    points, intensities = [], []
+    for rec in get_json(DATASETS["traffic"][0], window):
+        fields = rec.get("fields", {})
+        try:
+            inten = float(fields.get("intensidad"))
+        except (TypeError, ValueError):
+            continue
+        if len(fields.get("geo_point_2d") or []) == 2:
+            points.append(fields["geo_point_2d"])
+            intensities.append(inten)
+    if not points:
+        return None, np.empty(0)
+    return cKDTree(to_local_xy(points)), np.array(intensities)
+
+def get_traffic_index():
+    """Return the current traffic sensor index."""
+    return latest("traffic", build_traffic_index, "traffic", (None, np.empty(0)))
 
 # ----------------------------------------------------------------------------------------------------------------------
 # LAYOUT
@@ -185,8 +534,8 @@ col_map, col_ui = st.columns([3, 2])
 
 with col_ui:
     transport_mode = st.selectbox("Select transport mode", ["Walking", "Car", "Valenbisi", "Bus"])
-    start_point = st.text_input("Start address", "Plaza del Ayuntamiento, Valencia")
-    end_point = st.text_input("End address", "Ciudad de las Artes y las Ciencias, Valencia")
+    start_point = st.text_input("Start address", DEFAULT_START)
+    end_point = st.text_input("End address", DEFAULT_END)
 
     use_parking = None
     if transport_mode == "Car":
@@ -202,62 +551,82 @@ input_key = f"{transport_mode}_{start_point}_{end_point}_{use_parking}"
 # ----------------------------------------------------------------------------------------------------------------------
 # ROUTE & MAP
 # ----------------------------------------------------------------------------------------------------------------------
+def other_mode_legs(start_coords, end_coords, mode):
+    """Return the (coords, profile) legs the transport modes other than mode would request."""
+    legs = {
+        "Walking": [([lonlat(start_coords), lonlat(end_coords)], "foot-walking")],
+    }
+
+    if mode != "Car":
+        parking = find_closest(get_spatial_index("parkings"), end_coords)
+        if parking:
+            legs["Car"] = [
+                ([lonlat(start_coords), lonlat(parking["geo_point_2d"])], "driving-car"),
+                ([lonlat(parking["geo_point_2d"]), lonlat(end_coords)], "foot-walking"),
+            ]
+
+    if mode != "Valenbisi":
+        bikes = get_spatial_index("bikes")
+        st_start = find_closest(bikes, start_coords)
+        st_end = find_closest(bikes, end_coords)
+        if st_start and st_end:
+            legs["Valenbisi"] = [
+                ([lonlat(start_coords), lonlat(st_start["geo_point_2d"])], "foot-walking"),
+                ([lonlat(st_start["geo_point_2d"]), lonlat(st_end["geo_point_2d"])], "cycling-regular"),
+                ([lonlat(st_end["geo_point_2d"]), lonlat(end_coords)], "foot-walking"),
+            ]
+
+    return [leg for leg_mode, mode_legs in legs.items() if leg_mode != mode for leg in mode_legs]
+
+def prefetch_route(coords, profile):
+    """Fetch a leg into the route cache unless the ORS quota is needed for requested routes."""
+    if ors_has_headroom():
+        fetch_route(coords, profile)
+
+def prefetch_other_modes(start_coords, end_coords):
+    """Warm the route cache in the background with the legs the other transport modes would request."""
+    executor = get_prefetch_executor()
+    mode = transport_mode
+
+    def submit_legs():
+        # Runs on the pool, so the datasets the other modes need are loaded off the script thread too
+        return [executor.submit(prefetch_route, coords, profile)
+                for coords, profile in other_mode_legs(start_coords, end_coords, mode)]
+
+    st.session_state["prefetch"] = executor.submit(submit_legs)
+
 def build_map():
     """Compute route based on UI state and return folium map plus a notice string."""
+    cancel_prefetch()
     with st.spinner("Calculating route..."):
         start_coords = geocode(start_point)
         end_coords = geocode(end_point)
 
         if not start_coords:
             st.error(f"Could not find location: {start_point}")
-            return folium.Map(location=[39.4699, -0.3763], zoom_start=12), "Error: Could not geocode start address"
+            return new_map((39.4699, -0.3763), 12), "Error: Could not geocode start address"
         
         if not end_coords:
             st.error(f"Could not find location: {end_point}")
-            return folium.Map(location=[39.4699, -0.3763], zoom_start=12), "Error: Could not geocode end address"
+            return new_map((39.4699, -0.3763), 12), "Error: Could not geocode end address"
 
-        # Calculate center point
-        center = [(start_coords[0] + end_coords[0]) / 2, (start_coords[1] + end_coords[1]) / 2]
-        
-        # Create map with good zoom level
-        distance_km = geodesic(start_coords, end_coords).kilometers
-        if distance_km < 2:
-            zoom = 15
-        elif distance_km < 5:
-            zoom = 14
-        elif distance_km < 10:
-            zoom = 13
-        else:
-            zoom = 12
-        
-        m = folium.Map(location=center, zoom_start=zoom)
-        
-        # Add start and end markers
-        folium.Marker(
-            start_coords, 
-            tooltip="Start Point", 
-            popup=start_point,
-            icon=folium.Icon(color="green", icon="play")
-        ).add_to(m)
-        
-        folium.Marker(
-            end_coords, 
-            tooltip="End Point", 
-            popup=end_point,
-            icon=folium.Icon(color="red", icon="stop")
-        ).add_to(m)
+        # Base map framing both endpoints with their markers, shared across transport modes
+        m = copy.deepcopy(get_endpoints_map(start_coords, end_coords, start_point, end_point))
 
         notice = ""
 
         # CAR MODE
         if transport_mode == "Car":
+            # Load traffic alongside the parking lookup and route requests
+            traffic_index = get_executor().submit(get_traffic_index)
+
             def add_penalty(drive_route, base_seconds):
                 """Apply traffic penalty to car segment and return (total_seconds, penalty_seconds)."""
-                penalty = traffic_penalty_seconds(drive_route, traffic)
+                penalty = traffic_penalty_seconds(drive_route, traffic_index.result())
                 return base_seconds + penalty, penalty
 
             if use_parking == "Parking garage":
-                parking = find_closest(parkings, end_coords)
+                parking = find_closest(get_spatial_index("parkings"), end_coords)
                 if parking and parking.get("geo_point_2d"):
                     folium.Marker(
                         parking["geo_point_2d"], 
@@ -267,8 +636,10 @@ def build_map():
                     ).add_to(m)
                     
                     # Drive to parking + walk to destination
-                    r1 = get_route([start_coords[::-1], parking["geo_point_2d"][::-1]], profile="driving-car")
-                    r2 = get_route([parking["geo_point_2d"][::-1], end_coords[::-1]], profile="foot-walking")
+                    r1, r2 = get_routes(
+                        ([lonlat(start_coords), lonlat(parking["geo_point_2d"])], "driving-car"),
+                        ([lonlat(parking["geo_point_2d"]), lonlat(end_coords)], "foot-walking"),
+                    )
                     
                     if r1 and r2:
                         draw_route(m, r1, "blue", "Driving", 6)
@@ -284,7 +655,7 @@ def build_map():
                     notice = "⚠️ No parking garages found near destination"
             else:
                 # Direct driving
-                r = get_route([start_coords[::-1], end_coords[::-1]], profile="driving-car")
+                r = get_route([lonlat(start_coords), lonlat(end_coords)], profile="driving-car")
                 if r:
                     draw_route(m, r, "blue", "Driving", 6)
                     secs = r["features"][0]["properties"]["summary"]["duration"]
@@ -295,6 +666,7 @@ def build_map():
 
         # VALENBISI MODE
         elif transport_mode == "Valenbisi":
+            bikes = get_spatial_index("bikes")
             st_start = find_closest(bikes, start_coords)
             st_end = find_closest(bikes, end_coords)
             
@@ -314,9 +686,11 @@ def build_map():
                 ).add_to(m)
 
                 # Walk to bike + cycle + walk from bike
-                walk1 = get_route([start_coords[::-1], st_start["geo_point_2d"][::-1]], profile="foot-walking")
-                bike = get_route([st_start["geo_point_2d"][::-1], st_end["geo_point_2d"][::-1]], profile="cycling-regular")
-                walk2 = get_route([st_end["geo_point_2d"][::-1], end_coords[::-1]], profile="foot-walking")
+                walk1, bike, walk2 = get_routes(
+                    ([lonlat(start_coords), lonlat(st_start["geo_point_2d"])], "foot-walking"),
+                    ([lonlat(st_start["geo_point_2d"]), lonlat(st_end["geo_point_2d"])], "cycling-regular"),
+                    ([lonlat(st_end["geo_point_2d"]), lonlat(end_coords)], "foot-walking"),
+                )
 
                 if walk1 and bike and walk2:
                     draw_route(m, walk1, "green", "Walk to bike", 4)
@@ -332,7 +706,7 @@ def build_map():
 
         # WALKING MODE
         elif transport_mode == "Walking":
-            r = get_route([start_coords[::-1], end_coords[::-1]], profile="foot-walking")
+            r = get_route([lonlat(start_coords), lonlat(end_coords)], profile="foot-walking")
             if r:
                 draw_route(m, r, "green", "Walking", 5)
                 duration = r["features"][0]["properties"]["summary"]["duration"]
@@ -343,24 +717,25 @@ def build_map():
 
         # BUS MODE
         elif transport_mode == "Bus":
-            start_cand = k_closest(buses, start_coords)
-            end_cand = k_closest(buses, end_coords)
+            bus_index, stop_lines, line_stops = get_bus_lines_index()
+            start_cand = k_closest(bus_index, start_coords)
+            end_cand = k_closest(bus_index, end_coords)
 
             if not start_cand or not end_cand:
                 notice = "⚠️ No bus stops found near start/end points"
             else:
+                _, stop_latlon, stops = bus_index
+                start_walk = dict(zip(start_cand, haversine_m(stop_latlon[start_cand], start_coords)))
+                end_walk = dict(zip(end_cand, haversine_m(stop_latlon[end_cand], end_coords)))
                 best_pair, best_line, best_score = None, None, float("inf")
 
-                # Find best bus connection
+                # Find best bus connection: only follow lines serving a start candidate to the end candidates
                 for s in start_cand:
-                    for e in end_cand:
-                        lines = common_lines(s, e)
-                        if not lines:
-                            continue
-                        walk_score = (geodesic(start_coords, s["geo_point_2d"]).meters +
-                                     geodesic(end_coords, e["geo_point_2d"]).meters)
-                        if walk_score < best_score:
-                            best_pair, best_line, best_score = (s, e), next(iter(lines)), walk_score
+                    for line in sorted(stop_lines[s]):
+                        for e in line_stops[line] & end_walk.keys():
+                            walk_score = start_walk[s] + end_walk[e]
+                            if walk_score < best_score:
+                                best_pair, best_line, best_score = (stops[s], stops[e]), line, walk_score
 
                 if not best_pair:
                     notice = "⚠️ No direct bus line found between nearby stops"
@@ -383,9 +758,11 @@ def build_map():
                     ).add_to(m)
 
                     # Calculate routes
-                    walk1 = get_route([start_coords[::-1], stop_start["geo_point_2d"][::-1]], profile="foot-walking")
-                    walk2 = get_route([stop_end["geo_point_2d"][::-1], end_coords[::-1]], profile="foot-walking")
-                    bus_r = get_route([stop_start["geo_point_2d"][::-1], stop_end["geo_point_2d"][::-1]], profile="driving-car")
+                    walk1, walk2, bus_r = get_routes(
+                        ([lonlat(start_coords), lonlat(stop_start["geo_point_2d"])], "foot-walking"),
+                        ([lonlat(stop_end["geo_point_2d"]), lonlat(end_coords)], "foot-walking"),
+                        ([lonlat(stop_start["geo_point_2d"]), lonlat(stop_end["geo_point_2d"])], "driving-car"),
+                    )
 
                     if walk1 and bus_r and walk2:
                         draw_route(m, walk1, "green", "Walk to bus", 4)
@@ -402,37 +779,47 @@ def build_map():
                     else:
                         notice = f"⚠️ Could not calculate complete bus route for Line {best_line}"
 
+        prefetch_other_modes(start_coords, end_coords)
         return m, notice
 
 # ----------------------------------------------------------------------------------------------------------------------
 # SESSION STATE & MAP DISPLAY
 # ----------------------------------------------------------------------------------------------------------------------
-# Only rebuild map when inputs change or calculate button is pressed
-if ("last_input_key" not in st.session_state or 
-    st.session_state["last_input_key"] != input_key or 
-    calculate_route):
-    
-    map_obj, notice = build_map()
-    st.session_state.update({
-        "map": map_obj,
-        "notice": notice,
-        "last_input_key": input_key
-    })
+# Rendered results per input combination, so switching back to a recent mode or address pair
+# skips the rebuild; kept no longer than the real-time traffic TTL and never for failed builds
+MAP_CACHE_SIZE = 8
+MAP_CACHE_TTL = DATASETS["traffic"][1]
+
+def is_warning(notice: str) -> bool:
+    """Return True when a notice reports an error rather than a computed route."""
+    return "⚠️" in notice or "Error:" in notice
+
+# Only rebuild map when inputs change; otherwise re-send the HTML rendered last time
+if st.session_state.get("last_input_key") != input_key:
+    map_cache = st.session_state.setdefault("map_cache", {})
+    result = map_cache.get(input_key)
+    if result is None or time.monotonic() - result["built"] > MAP_CACHE_TTL:
+        map_obj, notice = build_map()
+        result = {
+            "map_html": map_obj.get_root().render(),
+            "notice": notice,
+            "built": time.monotonic(),
+        }
+        map_cache.pop(input_key, None)
+        if not is_warning(notice):
+            map_cache[input_key] = result
+            while len(map_cache) > MAP_CACHE_SIZE:
+                map_cache.pop(next(iter(map_cache)))
+    st.session_state.update(result, last_input_key=input_key)
 
 # Display results
 with col_ui:
     if st.session_state.get("notice"):
-        if "⚠️" in st.session_state["notice"] or "Error:" in st.session_state["notice"]:
+        if is_warning(st.session_state["notice"]):
             st.warning(st.session_state["notice"])
         else:
             st.success(st.session_state["notice"])
 
 with col_map:
-    if st.session_state.get("map"):
-        st_folium(
-            st.session_state["map"], 
-            use_container_width=True, 
-            height=800, 
-            key="route_map",
-            returned_objects=["last_object_clicked"]
-        )
+    if st.session_state.get("map_html"):
+        st.iframe(st.session_state["map_html"], height=800)